@@ -1,5 +1,6 @@
 """Displays bluetooth status with icons. Left mouse click launches manager app `blueman-manager`.
-Needs python-dbus to detect device types and nerd fonts to display the icons
+Needs python-dbus to detect device types and nerd fonts to display the icons.
+Device changes are picked up from BlueZ signals, which also needs PyGObject (gi)
 
 Parameters:
     * bluetooth.manager : application to launch on click (blueman-manager)
@@ -8,13 +9,38 @@ Adapted by `Diego <https://github.com/diesphink>`_ from bluetooth2 by `martindou
 """
 
 
-import re
+import logging
+import threading
 import dbus
 import dbus.mainloop.glib
+from gi.repository import GLib
 
 import core.module
 import core.widget
 import core.input
+import core.event
+
+_ICONS = {
+    'audio-headset': '',
+    'input-mouse': '',
+    'keyboard': '',
+    'input-keyboard': '',
+    'unknown': ''
+}
+
+# (name substring, icon) rules for devices that don't report an Icon property
+_NAME_RULES = (
+    ('keyboard', 'keyboard'),
+    ('mouse', 'input-mouse'),
+    ('headset', 'audio-headset'),
+)
+
+
+# D-Bus errors that only mean org.bluez is not running
+_GONE_ERRORS = (
+    "org.freedesktop.DBus.Error.ServiceUnknown",
+    "org.freedesktop.DBus.Error.NameHasNoOwner",
+)
 
 
 class Module(core.module.Module):
@@ -24,18 +50,40 @@ class Module(core.module.Module):
         self.manager = self.parameter("manager", "blueman-manager")
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
         self._bus = dbus.SystemBus()
+        self._get_managed = None
+        self._owner = None
+        self._status = None
+
+        self._devices = {}
+        self._connected = {}
+
+        self._bus.add_signal_receiver(
+            self._on_props_changed, bus_name="org.bluez",
+            dbus_interface="org.freedesktop.DBus.Properties",
+            signal_name="PropertiesChanged", arg0="org.bluez.Device1",
+            path_keyword="path")
+        self._bus.add_signal_receiver(
+            self._on_interfaces_added, bus_name="org.bluez",
+            dbus_interface="org.freedesktop.DBus.ObjectManager",
+            signal_name="InterfacesAdded")
+        self._bus.add_signal_receiver(
+            self._on_interfaces_removed, bus_name="org.bluez",
+            dbus_interface="org.freedesktop.DBus.ObjectManager",
+            signal_name="InterfacesRemoved")
+
+        # the owner watch reports the current owner of org.bluez once the loop
+        # runs and seeds the cache then, so no change after subscribing above
+        # is lost. A restarted bluetoothd sends no InterfacesRemoved, so the
+        # cache also starts over whenever org.bluez changes hands
+        self._bus.watch_name_owner("org.bluez", self._on_owner_changed)
+
+        # signals are only dispatched while a GLib main loop is running
+        self.__loop = threading.Thread(target=GLib.MainLoop().run, daemon=True)
+        self.__loop.start()
 
         core.input.register(
             self, button=core.input.LEFT_MOUSE, cmd=self.manager)
 
-        self._icons = {
-            'audio-headset': '',
-            'input-mouse': '',
-            'keyboard': '',
-            'input-keyboard': '',
-            'unknown': ''
-        }
-
     def status(self, widget):
         """Get status."""
         return self._status
@@ -44,7 +92,7 @@ class Module(core.module.Module):
         """Update current state."""
         devices = self.get_connected_devices()
         if devices:
-            self._status = " ".join([self._icons[dev['icon']]
+            self._status = " ".join([_ICONS.get(dev['icon'], _ICONS['unknown'])
                                     for dev in devices])
         else:
             self._status = None
@@ -58,25 +106,81 @@ class Module(core.module.Module):
         return self._status is None
 
     def get_connected_devices(self):
-        devices = []
-
-        objects = dbus.Interface(self._bus.get_object(
-            "org.bluez", "/"), "org.freedesktop.DBus.ObjectManager").GetManagedObjects()
-        for path, interfaces in objects.items():
-            if "org.bluez.Device1" in interfaces:
-
-                props = dbus.Interface(self._bus.get_object(
-                    "org.bluez", path), "org.freedesktop.DBus.Properties").GetAll("org.bluez.Device1")
-
-                if props['Connected'] == 1:
-                    device = {'Name': props['Name']}
-                    if 'Icon' in props:
-                        device['icon'] = props['Icon']
-                    elif re.search('keyboard', props['Name'], flags=re.IGNORECASE):
-                        device['icon'] = 'keyboard'
-                    else:
-                        device['icon'] = 'unknown'
-                    devices.append(device)
-        return devices
+        return [{'icon': icon} for icon in list(self._connected.values())]
+
+    def _seed(self):
+        """Fills the device cache from a single GetManagedObjects call"""
+        if self._get_managed is None:
+            # resolving the proxy needs org.bluez to be owned, so do it lazily
+            om = dbus.Interface(self._bus.get_object(
+                "org.bluez", "/", introspect=False),
+                "org.freedesktop.DBus.ObjectManager")
+            get_managed = om.GetManagedObjects
+        else:
+            get_managed = self._get_managed
+        for path, interfaces in get_managed().items():
+            self._on_interfaces_added(path, interfaces, notify=False)
+        self._get_managed = get_managed
+
+    def _device_icon(self, props):
+        if 'Icon' in props:
+            return props['Icon']
+        name_lower = props.get('Name', '').lower()
+        for substr, icon in _NAME_RULES:
+            if substr in name_lower:
+                return icon
+        return 'unknown'
+
+    def _refresh_device(self, path, notify=True):
+        props = self._devices.get(path)
+        if props and props.get('Connected') == 1:
+            self._connected[path] = self._device_icon(props)
+        else:
+            self._connected.pop(path, None)
+        if notify:
+            self._notify()
+
+    def _notify(self):
+        # called from the GLib thread, so only re-render and ask for a redraw
+        self.update()
+        core.event.trigger("update", [self.id], redraw_only=True)
+
+    def _on_owner_changed(self, owner):
+        if owner == self._owner:
+            return
+        self._owner = owner
+        self._get_managed = None
+        self._devices.clear()
+        self._connected.clear()
+        if owner:
+            try:
+                self._seed()
+            except dbus.exceptions.DBusException as e:
+                # bluetoothd going away again right after appearing is fine,
+                # anything else (e.g. AccessDenied) would hide the module silently
+                if e.get_dbus_name() not in _GONE_ERRORS:
+                    logging.exception("unable to query bluetooth devices")
+        self._notify()
+
+    def _on_props_changed(self, interface, changed, invalidated, path=None):
+        props = self._devices.get(path)
+        if props is None:
+            # not seen through GetManagedObjects or InterfacesAdded, so the
+            # changed properties alone would lack Name and Icon
+            return
+        props.update(changed)
+        for name in invalidated:
+            props.pop(name, None)
+        self._refresh_device(path)
+
+    def _on_interfaces_added(self, path, interfaces, notify=True):
+        if "org.bluez.Device1" in interfaces:
+            self._devices[path] = dict(interfaces["org.bluez.Device1"])
+            self._refresh_device(path, notify)
+
+    def _on_interfaces_removed(self, path, interfaces):
+        if "org.bluez.Device1" in interfaces:
+            self._devices.pop(path, None)
+            self._refresh_device(path)
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
\ No newline at end of file
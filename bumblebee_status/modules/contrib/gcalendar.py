@@ -11,7 +11,7 @@ Parameters:
     * gcalendar.time_format: Format time output. Defaults to "%H:%M".
     * gcalendar.date_format: Format date output. Defaults to "%d.%m.%y".
     * gcalendar.credentials_path: Path to credentials.json. Defaults to "~/".
-    * gcalendar.locale: locale to use rather than the system default.
+    * gcalendar.locale: locale to use rather than the system default. Only applied if a format uses locale dependent directives like %a or %b.
     * gcalendar.calendars: Comma separated list of calendar names that will be shown. Defaults to show all.
 
 Requires these pip packages:
@@ -23,26 +23,62 @@ Requires these pip packages:
 # This import belongs to the google code
 from __future__ import print_function
 
-from dateutil.parser import parse as dtparse
-
 import core.module
 import core.widget
 import core.decorators
 
 import datetime
+import heapq
+import json
 import os.path
 import locale
+import time
 
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp, Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.http import build_http
+
+SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
+# Seconds for which fetched events are reused instead of querying google again
+CACHE_TTL = 300
+# strftime directives whose output depends on the LC_TIME locale
+# (%E and %O are the alternative era and numeral modifiers, e.g. %Ec or %OH)
+LOCALE_DIRECTIVES = (
+    "%a", "%A", "%b", "%B", "%h", "%c", "%p", "%r", "%x", "%X", "%E", "%O"
+)
+
+
+def parse_date(value):
+    """Parses the RFC3339 dateTime or plain date of a google calendar event"""
+    if "T" not in value:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    if hasattr(datetime.datetime, "fromisoformat"):
+        return datetime.datetime.fromisoformat(value)
+    # python 3.6 has no fromisoformat, and its %z doesn't accept "+02:00"
+    value = value[:-3] + value[-2:]
+    fmt = "%Y-%m-%dT%H:%M:%S.%f%z" if "." in value else "%Y-%m-%dT%H:%M:%S%z"
+    return datetime.datetime.strptime(value, fmt)
+
+
+def has_upcoming(results, now):
+    """Whether any event that is not a whole day event starts at or after now"""
+    return any(
+        "dateTime" in event["start"]
+        and parse_date(event["start"]["dateTime"]) >= now
+        for events in results.values()
+        for event in events
+    )
 
 
 class Module(core.module.Module):
     @core.decorators.every(minutes=15)
     def __init__(self, config, theme):
         super().__init__(config, theme, core.widget.Widget(self.status))
+        self.background = True
         self.__time_format = self.parameter("time_format", "%H:%M")
         self.__date_format = self.parameter("date_format", "%d.%m.%y")
         self.__credentials_path = os.path.expanduser(
@@ -50,20 +86,32 @@ class Module(core.module.Module):
         )
         self.__credentials = os.path.join(self.__credentials_path, "credentials.json")
         self.__token = os.path.join(self.__credentials_path, ".gcalendar_token.json")
+        self.__cache = os.path.join(self.__credentials_path, ".gcalendar_cache.json")
 
-        l = locale.getdefaultlocale()
-        if not l or l == (None, None):
-            l = ("en_US", "UTF-8")
-        lcl = self.parameter("locale", ".".join(l))
-        try:
-            locale.setlocale(locale.LC_TIME, lcl.split("."))
-        except Exception:
-            locale.setlocale(locale.LC_TIME, ("en_US", "UTF-8"))
+        # The locale is process-wide, so only touch it if the output depends on it
+        formats = self.__time_format + self.__date_format
+        if any(directive in formats for directive in LOCALE_DIRECTIVES):
+            l = locale.getdefaultlocale()
+            if not l or l == (None, None):
+                l = ("en_US", "UTF-8")
+            lcl = self.parameter("locale", ".".join(l))
+            try:
+                locale.setlocale(locale.LC_TIME, lcl.split("."))
+            except Exception:
+                locale.setlocale(locale.LC_TIME, ("en_US", "UTF-8"))
 
         self.__calendars = self.parameter("calendars", None)
         if self.__calendars:
             self.__calendars = [x.strip() for x in self.__calendars.split(',')]
+        # One connection is shared by token refreshes and all api requests.
+        # build_http keeps googleapiclient's socket timeout, so a stalled
+        # request can't block the background update forever
+        self.__http = build_http()
+        self.__creds = None
+        self.__service = None
         self._events = []
+        self._rendered_collapsed = ""
+        self._rendered_expanded = ""
         self._expanded = False
 
         core.input.register(self, button=core.input.LEFT_MOUSE, cmd=self.toggle, wait=True)
@@ -71,123 +119,187 @@ class Module(core.module.Module):
 
     def toggle(self, _):
         self._expanded = not self._expanded
-        self.update()
 
     def status(self, widget):
         """Get status."""
         if self._expanded:
-            return "  ".join(self._events)
-        elif len(self._events) > 1:
-            return f"{self._events[0]} (+{len(self._events) - 1})"
-        elif len(self._events) == 1:
-            return self._events[0]
-        else:
-            return ""
-        return f'{self._status} ({self._expanded})'
+            return self._rendered_expanded
+        return self._rendered_collapsed
 
     def update(self):
         """Update current state."""
-        self._events = self.get_events()
+        events = self.get_events()
+        if len(events) > 1:
+            self._rendered_collapsed = f"{events[0]} (+{len(events) - 1})"
+        elif len(events) == 1:
+            self._rendered_collapsed = events[0]
+        else:
+            self._rendered_collapsed = ""
+        self._rendered_expanded = "  ".join(events)
+        self._events = events
 
     def hidden(self):
         return self._events == []
 
-    def get_events(self):
-        SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
-
-        """Shows basic usage of the Google Calendar API.
-        Prints the start and name of the next 10 events on the user's calendar.
-        """
-        creds = None
+    def get_service(self):
+        # The credentials and the service built on top of them are kept between
+        # updates; expired credentials are refreshed in place, which the service
+        # picks up since it holds the same credentials object.
+        creds = self.__creds
         # The file token.json stores the user's access and refresh tokens, and is
         # created automatically when the authorization flow completes for the first
         # time.
-        if os.path.exists(self.__token):
+        if not creds and os.path.exists(self.__token):
             creds = Credentials.from_authorized_user_file(self.__token, SCOPES)
         # If there are no (valid) credentials available, let the user log in.
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
+                creds.refresh(Request(self.__http))
             else:
                 flow = InstalledAppFlow.from_client_secrets_file(
                     self.__credentials, SCOPES
                 )
                 creds = flow.run_local_server(port=0)
+                self.__service = None
             # Save the credentials for the next run
             with open(self.__token, "w") as token:
                 token.write(creds.to_json())
+        self.__creds = creds
+
+        if self.__service is None:
+            self.__service = build(
+                "calendar",
+                "v3",
+                http=AuthorizedHttp(creds, http=self.__http),
+                cache_discovery=False,
+            )
+        return self.__service
+
+    def query_calendars(self, now, ends):
+        """Returns the events of the selected calendars, keyed by calendar id.
 
-        # try:
-        service = build("calendar", "v3", credentials=creds)
+        The time window is widened to each of the given ends in turn until an
+        event that is not a whole day event starts at or after now. Events that
+        are already running are returned as well, as google matches on the end.
+        """
+        service = self.get_service()
 
-        # Call the Calendar API
-        now = datetime.datetime.utcnow().isoformat() + "Z"  # 'Z' indicates UTC time
-        end = (
-            datetime.datetime.utcnow() + datetime.timedelta(days=7)
-        ).isoformat() + "Z"  # 'Z' indicates UTC time
         # Get all calendars
-        calendar_list = service.calendarList().list().execute()
-        event_list = []
-        for calendar_list_entry in calendar_list["items"]:
-            if self.__calendars:
-                if calendar_list_entry['summary'] not in self.__calendars:
-                    continue
-
-            calendar_id = calendar_list_entry["id"]
-            events_result = (
-                service.events()
-                .list(
-                    calendarId=calendar_id,
-                    timeMin=now,
-                    timeMax=end,
-                    singleEvents=True,
-                    orderBy="startTime",
+        calendar_list = (
+            service.calendarList().list(fields="items(id,summary)").execute()
+        )
+        calendar_ids = [
+            calendar_list_entry["id"]
+            for calendar_list_entry in calendar_list["items"]
+            if not self.__calendars
+            or calendar_list_entry['summary'] in self.__calendars
+        ]
+
+        for end in ends:
+            # Query all calendars in a single batched HTTP request
+            results = {}
+
+            def collect(request_id, response, exception):
+                if exception is not None:
+                    raise exception
+                results[request_id] = response.get("items", [])
+
+            batch = service.new_batch_http_request(callback=collect)
+            for calendar_id in calendar_ids:
+                batch.add(
+                    service.events().list(
+                        calendarId=calendar_id,
+                        timeMin=now.isoformat(),
+                        timeMax=end,
+                        singleEvents=True,
+                        orderBy="startTime",
+                        fields="items(start,summary,eventType)",
+                    ),
+                    request_id=calendar_id,
                 )
-                .execute()
-            )
-            events = events_result.get("items", [])
+            batch.execute()
 
+            if has_upcoming(results, now):
+                break
+        return results
+
+    def read_cache(self, key):
+        try:
+            with open(self.__cache) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cache.get("key") != key or time.time() - cache.get("time", 0) > CACHE_TTL:
+            return None
+        return cache.get("events")
+
+    def write_cache(self, key, results):
+        try:
+            with open(self.__cache, "w") as f:
+                json.dump({"key": key, "time": time.time(), "events": results}, f)
+        except OSError:
+            pass
+
+    def get_events(self):
+        """Returns the upcoming events of the nearest day that has any."""
+        now_utc = datetime.datetime.now(datetime.timezone.utc)
+        today = now_utc.astimezone().date()
+        # Only ask for the rest of today first, then for up to a week ahead.
+        # Local midnights are resolved one by one, as the offset changes with DST
+        ends = [
+            datetime.datetime.combine(
+                today + datetime.timedelta(days=days), datetime.time()
+            ).astimezone().isoformat()
+            for days in (1, 2, 3, 7)
+        ]
+
+        # Recently fetched events are reused, e.g. across restarts of the bar
+        key = [
+            sorted(self.__calendars) if self.__calendars else None,
+            today.isoformat(),
+            time.strftime("%z"),
+        ]
+        results = self.read_cache(key)
+        # the cached window may only hold events that have started by now
+        if results is None or not has_upcoming(results, now_utc):
+            results = self.query_calendars(now_utc, ends)
+            self.write_cache(key, results)
+
+        # Every calendar is already sorted by start time, so merge instead of sort
+        event_lists = []
+        for events in results.values():
+            event_list = []
+            event_lists.append(event_list)
             for event in events:
-                start = dtparse(
+                start = parse_date(
                     event["start"].get("dateTime", event["start"].get("date"))
                 )
                 # Only add to list if not an whole day event
-                if start.tzinfo:
+                if isinstance(start, datetime.datetime) and start.tzinfo:
                     event_list.append(
-                        {
-                            "date": start,
-                            "summary": event["summary"],
-                            "type": event["eventType"],
-                        }
+                        (start, event["summary"], event["eventType"])
                     )
-        sorted_list = sorted(event_list, key=lambda t: t["date"])
+        # (date, summary, type) tuples order by date first
+        sorted_list = heapq.merge(*event_lists)
+
+        fmt_short = self.__time_format
+        fmt_long = f"{self.__date_format} {self.__time_format}"
 
         smaller_date = None
         events = []
-        for gevent in sorted_list:
-            if (gevent["date"] >= datetime.datetime.now(datetime.timezone.utc) 
-                and (smaller_date is None  or smaller_date == gevent['date'].date())):
-                if gevent["date"].date() == datetime.datetime.utcnow().date() or smaller_date is not None:
-                    events.append(str(
-                        "%s %s"
-                        % (
-                            gevent["date"]
-                            .astimezone()
-                            .strftime(f"{self.__time_format}"),
-                            gevent["summary"],
-                        )
-                    ))
+        for start, summary, _ in sorted_list:
+            # compare local dates, calendars may use different offsets
+            local = start.astimezone()
+            if smaller_date is not None and local.date() > smaller_date:
+                break
+            if (start >= now_utc
+                and (smaller_date is None  or smaller_date == local.date())):
+                if local.date() == today or smaller_date is not None:
+                    fmt = fmt_short
                 else:
-                    events.append(str(
-                        "%s %s"
-                        % (
-                            gevent["date"]
-                            .astimezone()
-                            .strftime(f"{self.__date_format} {self.__time_format}"),
-                            gevent["summary"],
-                        )
-                    ))
-                smaller_date = gevent['date'].date()
+                    fmt = fmt_long
+                events.append(str("%s %s" % (local.strftime(fmt), summary)))
+                smaller_date = local.date()
 
         return events
 
@@ -0,0 +1,108 @@
+import sys
+import importlib
+import pytest
+from unittest.mock import Mock
+
+import core.config
+
+for name in ["dbus", "dbus.mainloop", "dbus.mainloop.glib", "gi", "gi.repository"]:
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        sys.modules[name] = Mock()
+
+bluetooth_icons = importlib.import_module("modules.contrib.bluetooth-icons")
+
+KEYBOARD = "/org/bluez/hci0/dev_00_00_00_00_00_01"
+HEADSET = "/org/bluez/hci0/dev_00_00_00_00_00_02"
+
+
+class DBusException(Exception):
+    pass
+
+
+def device(name, connected, icon=None):
+    props = {"Name": name, "Connected": connected}
+    if icon:
+        props["Icon"] = icon
+    return {"org.bluez.Device1": props}
+
+
+@pytest.fixture
+def dbus(mocker):
+    dbus = mocker.patch.object(bluetooth_icons, "dbus")
+    dbus.exceptions.DBusException = DBusException
+    mocker.patch.object(bluetooth_icons, "GLib")
+    mocker.patch("core.event.trigger")
+    return dbus
+
+
+def build_module(dbus, objects):
+    dbus.Interface.return_value.GetManagedObjects.return_value = objects
+    module = bluetooth_icons.Module(config=core.config.Config([]), theme=None)
+    module._on_owner_changed(":1.1")
+    return module
+
+
+def test_load_module():
+    importlib.import_module("modules.contrib.bluetooth-icons")
+
+
+def test_seeded_once_per_owner(dbus):
+    module = build_module(dbus, {KEYBOARD: device("My Keyboard", True)})
+    module._on_owner_changed(":1.1")
+
+    assert dbus.Interface.return_value.GetManagedObjects.call_count == 1
+    assert module._status == bluetooth_icons._ICONS["keyboard"]
+
+
+def test_known_device_disconnects(dbus):
+    module = build_module(dbus, {KEYBOARD: device("My Keyboard", True)})
+
+    module._on_props_changed("org.bluez.Device1", {"Connected": False}, [], path=KEYBOARD)
+
+    assert module._status is None
+
+
+def test_unknown_device_is_ignored(dbus):
+    module = build_module(dbus, {})
+
+    module._on_props_changed("org.bluez.Device1", {"Connected": True}, [], path=HEADSET)
+
+    assert HEADSET not in module._devices
+    assert module._status is None
+
+
+def test_added_and_removed_device(dbus):
+    module = build_module(dbus, {})
+
+    module._on_interfaces_added(HEADSET, device("Headset", True, "audio-headset"))
+    assert module._status == bluetooth_icons._ICONS["audio-headset"]
+
+    module._on_interfaces_removed(HEADSET, ["org.bluez.Device1"])
+    assert module._status is None
+
+
+def test_bluetoothd_restart(dbus):
+    module = build_module(dbus, {KEYBOARD: device("My Keyboard", True)})
+
+    module._on_owner_changed("")
+    assert module._status is None
+
+    dbus.Interface.return_value.GetManagedObjects.return_value = {
+        HEADSET: device("Headset", True, "audio-headset")
+    }
+    module._on_owner_changed(":1.2")
+    assert module._status == bluetooth_icons._ICONS["audio-headset"]
+
+
+def test_seed_error_is_logged(dbus, mocker):
+    log = mocker.patch.object(bluetooth_icons.logging, "exception")
+    error = DBusException()
+    error.get_dbus_name = lambda: "org.freedesktop.DBus.Error.AccessDenied"
+    dbus.Interface.return_value.GetManagedObjects.side_effect = error
+
+    module = build_module(dbus, {})
+
+    assert log.called
+    assert module._status is None
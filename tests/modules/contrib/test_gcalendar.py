@@ -0,0 +1,174 @@
+import sys
+import time
+import datetime
+import importlib
+import pytest
+from unittest.mock import Mock
+
+import core.config
+
+for name in [
+    "httplib2",
+    "google",
+    "google.oauth2",
+    "google.oauth2.credentials",
+    "google_auth_httplib2",
+    "google_auth_oauthlib",
+    "google_auth_oauthlib.flow",
+    "googleapiclient",
+    "googleapiclient.discovery",
+    "googleapiclient.http",
+]:
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        sys.modules[name] = Mock()
+
+import modules.contrib.gcalendar
+
+
+class FakeService:
+    """Answers events().list() like google does: by end time and window"""
+
+    def __init__(self, events):
+        self.calendar_events = events
+        self.queried_ends = []
+
+    def calendarList(self):
+        return Mock(**{"list.return_value.execute.return_value": {
+            "items": [{"id": "primary", "summary": "primary"}]
+        }})
+
+    def events(self):
+        return Mock(list=lambda **kwargs: kwargs)
+
+    def new_batch_http_request(self, callback):
+        service = self
+
+        class Batch:
+            def __init__(self):
+                self.__requests = []
+
+            def add(self, request, request_id):
+                self.__requests.append((request_id, request))
+
+            def execute(self):
+                for request_id, request in self.__requests:
+                    service.queried_ends.append(request["timeMax"])
+                    time_min = modules.contrib.gcalendar.parse_date(request["timeMin"])
+                    time_max = modules.contrib.gcalendar.parse_date(request["timeMax"])
+                    items = [
+                        {"start": {"dateTime": start.isoformat()},
+                         "summary": summary, "eventType": "default"}
+                        for start, end, summary in service.calendar_events
+                        if end > time_min and start < time_max
+                    ]
+                    callback(request_id, {"items": items}, None)
+
+        return Batch()
+
+
+def build_module(mocker, tmp_path, events):
+    module = modules.contrib.gcalendar.Module(
+        config=core.config.Config(["-p", "gcalendar.credentials_path={}".format(tmp_path)]),
+        theme=None,
+    )
+    service = FakeService(events)
+    mocker.patch.object(module, "get_service", return_value=service)
+    return module, service
+
+
+def test_load_module():
+    __import__("modules.contrib.gcalendar")
+
+
+@pytest.mark.parametrize("value,expected", [
+    ("2021-05-01", datetime.date(2021, 5, 1)),
+    ("2021-05-01T10:30:00Z",
+     datetime.datetime(2021, 5, 1, 10, 30, tzinfo=datetime.timezone.utc)),
+    ("2021-05-01T10:30:00+02:00",
+     datetime.datetime(2021, 5, 1, 8, 30, tzinfo=datetime.timezone.utc)),
+])
+def test_parse_date(value, expected):
+    assert modules.contrib.gcalendar.parse_date(value) == expected
+
+
+def test_ongoing_event_widens_window(mocker, tmp_path):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    tomorrow = (
+        datetime.datetime.combine(
+            now.astimezone().date() + datetime.timedelta(days=1), datetime.time(10)
+        ).astimezone()
+    )
+    module, service = build_module(mocker, tmp_path, [
+        (now - datetime.timedelta(minutes=30), now + datetime.timedelta(minutes=30), "ongoing"),
+        (tomorrow, tomorrow + datetime.timedelta(hours=1), "tomorrow"),
+    ])
+
+    events = module.get_events()
+
+    assert len(service.queried_ends) == 2
+    assert len(events) == 1
+    assert events[0].endswith(" tomorrow")
+
+
+def test_upcoming_event_today_keeps_window(mocker, tmp_path):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    start = now + datetime.timedelta(seconds=1)
+    module, service = build_module(mocker, tmp_path, [
+        (start, start + datetime.timedelta(seconds=1), "soon"),
+    ])
+
+    events = module.get_events()
+
+    assert len(service.queried_ends) == 1
+    assert events[0].endswith(" soon")
+
+
+def test_cache_without_upcoming_event_is_refreshed(mocker, tmp_path):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    started = now - datetime.timedelta(minutes=30)
+    later = now + datetime.timedelta(hours=1)
+    module, service = build_module(mocker, tmp_path, [
+        (started, now + datetime.timedelta(minutes=30), "ongoing"),
+        (later, later + datetime.timedelta(hours=1), "later"),
+    ])
+    module.write_cache(
+        [None, now.astimezone().date().isoformat(), time.strftime("%z")],
+        {"primary": [{"start": {"dateTime": started.isoformat()},
+                      "summary": "ongoing", "eventType": "default"}]},
+    )
+
+    events = module.get_events()
+
+    assert len(service.queried_ends) > 0
+    assert events[-1].endswith(" later")
+
+
+@pytest.fixture
+def utc(monkeypatch):
+    monkeypatch.setenv("TZ", "UTC")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_events_in_other_offsets_use_local_date(mocker, tmp_path, utc):
+    tomorrow = datetime.datetime.combine(
+        datetime.datetime.now(datetime.timezone.utc).date() + datetime.timedelta(days=1),
+        datetime.time(10),
+        datetime.timezone.utc,
+    )
+    # already the day after tomorrow in its own offset
+    far_east = tomorrow.astimezone(datetime.timezone(datetime.timedelta(hours=14)))
+    module, service = build_module(mocker, tmp_path, [
+        (far_east, far_east + datetime.timedelta(hours=1), "first"),
+        (tomorrow + datetime.timedelta(hours=1), tomorrow + datetime.timedelta(hours=2), "second"),
+    ])
+
+    events = module.get_events()
+
+    assert len(events) == 2
+    assert events[0].endswith(" first")
+    assert events[1].endswith(" second")